@@ -1,8 +1,11 @@
 import struct
+import mmap
 from collections import namedtuple
+from array import array
 import os
-from functools import lru_cache
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 import logging
 from datetime import datetime, timedelta
 
@@ -19,6 +22,11 @@ filetypes = {
 
 Flags = namedtuple('Flags', ['allocated', 'long_file', 'modified', 'deleted'])
 
+FLAG_ALLOCATED = 0x0001
+FLAG_LONG_FILE = 0x0002
+FLAG_MODIFIED = 0x0020
+FLAG_DELETED = 0x0040
+
 ISOVolumeLabel = namedtuple(
     'ISOVolumeLabel',
     [
@@ -42,6 +50,7 @@ RMXVolumeInformation = namedtuple(
 
 )
 
+# times are stored as seconds since the file system epoch
 FileNode = namedtuple(
     'FileNode',
     [
@@ -52,14 +61,28 @@ FileNode = namedtuple(
 )
 
 
-class File:
-    def __init__(self, abspath, filesystem):
-        self.fnode = filesystem._path_to_fnode(abspath)
-        assert self.fnode.type == 'data'
+class _Timestamps:
+    ''' datetime access to the fnode times, stored as seconds since the epoch '''
+
+    @property
+    def creation_time(self):
+        return self.filesystem._to_datetime(self.fnode.creation_time)
+
+    @property
+    def modification_time(self):
+        return self.filesystem._to_datetime(self.fnode.modification_time)
 
-        self.creation_time = self.fnode.creation_time
-        self.modification_time = self.fnode.creation_time
-        self.access_time = self.fnode.access_time
+    @property
+    def access_time(self):
+        return self.filesystem._to_datetime(self.fnode.access_time)
+
+
+class File(_Timestamps):
+    def __init__(self, abspath, filesystem, fnode=None):
+        if fnode is None:
+            fnode = filesystem._path_to_fnode(abspath)
+        self.fnode = fnode
+        assert self.fnode.type == 'data'
 
         self.filesystem = filesystem
         self.abspath = abspath
@@ -68,21 +91,23 @@ class File:
     def read(self):
         return self.filesystem._gather_blocks(self.fnode.block_pointers)
 
+    def copy_to(self, fileobj):
+        ''' write the file content to `fileobj` one block run at a time '''
+        self.filesystem._copy_blocks(self.fnode.block_pointers, fileobj)
+
     def __repr__(self):
         return 'File({}) at {}'.format(self.abspath, self.filesystem.fp.name)
 
 
-class Directory:
-    def __init__(self, abspath, filesystem):
-        self.fnode = filesystem._path_to_fnode(abspath)
+class Directory(_Timestamps):
+    def __init__(self, abspath, filesystem, fnode=None):
+        if fnode is None:
+            fnode = filesystem._path_to_fnode(abspath)
+        self.fnode = fnode
         assert self.fnode.type == 'directory'
         self.filesystem = filesystem
         self.abspath = abspath
 
-        self.creation_time = self.fnode.creation_time
-        self.modification_time = self.fnode.creation_time
-        self.access_time = self.fnode.access_time
-
         self.files = []
         self.directories = []
         for name, fnode in filesystem._read_directory(self.fnode).items():
@@ -107,67 +132,123 @@ class Directory:
 BlockPointer = namedtuple('BlockPointer', ['num_blocks', 'first_block'])
 
 
+class FileNodePointers:
+    '''
+    the block pointers of a long file as two parallel arrays of uint32.
+    Like the tuple of BlockPointers used for short files, it iterates over
+    (num_blocks, first_block) pairs and supports len, but it cannot be
+    indexed and compares by identity; use list() for a comparable copy.
+    '''
+    __slots__ = ('num_blocks', 'first_block')
+
+    def __init__(self):
+        self.num_blocks = array('I')
+        self.first_block = array('I')
+
+    def append(self, num_blocks, first_block):
+        self.num_blocks.append(num_blocks)
+        self.first_block.append(first_block)
+
+    def __iter__(self):
+        return zip(self.num_blocks, self.first_block)
+
+    def __len__(self):
+        return len(self.num_blocks)
+
+    def __repr__(self):
+        return 'FileNodePointers({})'.format(
+            [BlockPointer(*pointer) for pointer in self]
+        )
+
+
+_ISO_VOL_LABEL_STRUCT = struct.Struct('3sx6ss60xs4x2sxs48x')
+_RMX_VOLUME_INFO_STRUCT = struct.Struct('<10sxBHIHIHH100x')
+# block addresses are 24 bit little endian, split into a 16 and an 8 bit part
+_PTR_STRUCT = struct.Struct('<HHB')
+_IND_STRUCT = struct.Struct('<BHB')
+_DIRENT_STRUCT = struct.Struct('H14s')
+_DELETED_ENTRY_NAME = 14 * b'@'
+_FNODE_STRUCT = struct.Struct('<HBBHIIIII40sI4xH9sH')
+
+_RMX_VOLUME_INFO_OFFSET = 384
+_ISO_VOL_LABEL_OFFSET = 768
+# both volume headers are parsed from one read of the start of the device
+_HEADER_SIZE = _ISO_VOL_LABEL_OFFSET + _ISO_VOL_LABEL_STRUCT.size
+
+
 class FileSystem:
     def __init__(self, filename, epoch=datetime(1978, 1, 1)):
         self.fp = open(filename, 'rb')
+        # the size of block devices is only reported via seek, not stat
+        try:
+            size = self.fp.seek(0, os.SEEK_END)
+            self._mm = mmap.mmap(self.fp.fileno(), size, access=mmap.ACCESS_READ)
+        except Exception:
+            self.fp.close()
+            raise
         self.epoch = epoch
         self._fnodes = {}
-        self._read_iso_vol_label()
-        self._read_rmx_volume_information()
+        self._fnode_ids = {}
+        self._directory_cache = {}
+        header = self._read_at(0, _HEADER_SIZE)
+        self._read_iso_vol_label(header)
+        self._read_rmx_volume_information(header)
         self._read_fnode_file()
         self._root = self._fnodes[self.rmx_volume_information.root_fnode]
+        self._path_cache = {(): self._root}
         self._cwd = '/'
 
     def __getitem__(self, path):
         path = self.abspath(path)
-        fnode = self._path_to_fnode(path)
+        return self.open_fnode(self._path_to_fnode(path), path)
+
+    def open_fnode(self, fnode, path):
+        ''' wrap an fnode found at `path`, e.g. by walk, in a File or Directory '''
         if fnode.type == 'data':
-            return File(path, self)
+            return File(path, self, fnode)
         elif fnode.type == 'directory':
-            return Directory(path, self)
+            return Directory(path, self, fnode)
 
     def __repr__(self):
         return 'iRmx86-Filesystem at {}'.format(self.fp.name)
 
-    @lru_cache()
     def _path_to_fnode(self, path):
         path = self.abspath(path)
-        *dirs, filename = path.split('/')[1:]
-
-        current_dir = self._read_directory(self._root)
-        current_node = self._root
-        for d in dirs:
+        parts = self._split_path(path)
+        try:
+            return self._path_cache[parts]
+        except KeyError:
+            pass
+
+        node = self._root
+        for depth, name in enumerate(parts, 1):
             try:
-                current_node = current_dir[d]
-                current_dir = self._read_directory(current_dir[d])
+                node = self._path_cache[parts[:depth]]
+                continue
             except KeyError:
-                raise IOError('No such file or directory: {}'.format(path))
+                pass
 
-        if filename:
             try:
-                node = current_dir[filename]
+                node = self._read_directory(node)[name]
             except KeyError:
                 raise IOError('No such file or directory: {}'.format(path))
-        else:
-            node = current_node
-        return node
-
-    def _read_without_position_change(self, start, num_bytes):
-        current_position = self.fp.tell()
-        self.fp.seek(start, 0)
-        b = self.fp.read(num_bytes)
-        self.fp.seek(current_position, 0)
+            self._path_cache[parts[:depth]] = node
 
-        return b
+        return node
 
-    def _read_iso_vol_label(self):
+    @staticmethod
+    def _split_path(path):
+        ''' split an absolute path into a tuple of its components '''
+        return tuple(part for part in path.split('/') if part)
 
-        raw_data = self._read_without_position_change(768, 128)
+    def _read_at(self, start, num_bytes):
+        return self._mm[start:start + num_bytes]
 
+    def _read_iso_vol_label(self, header):
         (
             label, name, structure, recording_side,
             interleave_factor, iso_version
-        ) = struct.unpack('3sx6ss60xs4x2sxs48x', raw_data)
+        ) = _ISO_VOL_LABEL_STRUCT.unpack_from(header, _ISO_VOL_LABEL_OFFSET)
 
         label = label.decode('ascii').strip()
         name = name.decode('ascii').strip()
@@ -181,13 +262,11 @@ class FileSystem:
             interleave_factor, iso_version
         )
 
-    def _read_rmx_volume_information(self):
-        raw_data = self._read_without_position_change(384, 128)
-
+    def _read_rmx_volume_information(self, header):
         (
             name, file_driver, block_size, volume_size,
             num_fnodes, fnode_start, fnode_size, root_fnode
-        ) = struct.unpack('<10sxBHIHIHH100x', raw_data)
+        ) = _RMX_VOLUME_INFO_STRUCT.unpack_from(header, _RMX_VOLUME_INFO_OFFSET)
         name = name.decode().strip('\x00')
         file_driver = int(file_driver)
 
@@ -201,142 +280,172 @@ class FileSystem:
         num_fnodes = self.rmx_volume_information.num_fnodes
         fnode_size = self.rmx_volume_information.fnode_size
 
-        raw_data = self._read_without_position_change(
-            start, num_fnodes * fnode_size,
-        )
-
-        for fnode_id in range(num_fnodes):
-            start = fnode_id * fnode_size
-            end = (fnode_id + 1) * fnode_size
-            fnode_data = raw_data[start:end]
+        # allocated and deleted both live in the low byte of the flags,
+        # so pick out the live fnodes from that column before parsing any
+        live_mask = FLAG_ALLOCATED | FLAG_DELETED
 
-            fnode = self._read_fnode(fnode_data)
+        # parse the table in place in the mapping, without copying it
+        end = start + num_fnodes * fnode_size
+        with memoryview(self._mm) as mm_view, mm_view[start:end] as raw_data:
+            low_flag_bytes = bytes(raw_data[::fnode_size])
 
-            if fnode.flags.allocated and not fnode.flags.deleted:
-                self._fnodes[fnode_id] = fnode
-
-    def _read_fnode(self, raw_data):
-        fmt = '<HBBHIIIII40sI4xH9sH'
-        fmt_size = struct.calcsize(fmt)
-        num_aux_bytes = self.rmx_volume_information.fnode_size - fmt_size
-
-        elems = struct.unpack(fmt + '{}x'.format(num_aux_bytes), raw_data)
+            for fnode_id, low_flags in enumerate(low_flag_bytes):
+                if low_flags & live_mask == FLAG_ALLOCATED:
+                    fnode = self._read_fnode(raw_data, fnode_id * fnode_size)
+                    self._fnodes[fnode_id] = fnode
+                    self._fnode_ids[id(fnode)] = fnode_id
 
+    def _read_fnode(self, raw_data, offset=0):
         (
             flags, file_type, granularity, owner, creation_time,
             access_time, modification_time, total_size, total_blocks,
             pointer_data, size, id_count, accessor_data, parent
-        ) = elems
+        ) = _FNODE_STRUCT.unpack_from(raw_data, offset)
 
         flags = self._parse_flags(flags)
         file_type = filetypes[file_type]
         pointers = self._parse_pointer_data(pointer_data)
-        creation_time = self.epoch + timedelta(seconds=creation_time)
-        access_time = self.epoch + timedelta(seconds=access_time)
-        modification_time = self.epoch + timedelta(seconds=modification_time)
 
         if flags.long_file:
-            block_pointers = []
-            for num_blocks, first_block in pointers:
-                block_pointers.extend(
-                    self._parse_indirect_blocks(num_blocks, first_block)
-                )
+            block_pointers = self._parse_indirect_blocks(pointers)
         else:
             block_pointers = pointers
 
         return FileNode(
             flags, file_type, granularity, owner, creation_time,
             access_time, modification_time, total_size, total_blocks,
-            tuple(block_pointers), size, id_count, accessor_data, parent
+            block_pointers, size, id_count, accessor_data, parent
         )
 
     def _parse_pointer_data(self, data):
-        fmt = '<H3s'
-        s = struct.calcsize(fmt)
-        pointers = []
-        for start in range(0, 8 * s, s):
-            num_blocks, block_address = struct.unpack(fmt, data[start: start + s])
-
-            if num_blocks == 0:
-                continue
-
-            block_address = self._read_24bit_integer(block_address)
-            pointers.append(BlockPointer(num_blocks, block_address))
-
-        return pointers
-
-    @staticmethod
-    def _read_24bit_integer(data):
-        val, = struct.unpack('<I', data + b'\x00')
-        return val
-
-    def _parse_indirect_blocks(self, num_blocks, first_block):
-        fmt = '<B3s'
-        s = struct.calcsize(fmt)
-        data = self._read_without_position_change(
-            first_block, num_blocks * s
+        return tuple(
+            BlockPointer(num_blocks, low | high << 16)
+            for num_blocks, low, high in _PTR_STRUCT.iter_unpack(data)
+            if num_blocks != 0
         )
 
-        indirect_blocks = []
-        for start in range(0, num_blocks * s, s):
-            num_blocks, block_address = struct.unpack(fmt, data[start: start + s])
-            block_address = self._read_24bit_integer(block_address)
-            indirect_blocks.append(BlockPointer(num_blocks, block_address))
+    def _parse_indirect_blocks(self, pointers):
+        ''' resolve the indirect block tables of a long file '''
+        indirect_blocks = FileNodePointers()
+
+        # parse the tables in place in the mapping, without copying them
+        with memoryview(self._mm) as mm_view:
+            for num_blocks, first_block in pointers:
+                end = first_block + num_blocks * _IND_STRUCT.size
+                with mm_view[first_block:end] as data:
+                    for num, low, high in _IND_STRUCT.iter_unpack(data):
+                        indirect_blocks.append(num, low | high << 16)
 
-        return indirect_blocks
+        # share the empty tuple instead of keeping empty arrays around
+        return indirect_blocks if indirect_blocks else ()
 
     @staticmethod
     def _parse_flags(flags):
-        flags = '{0:016b}'.format(flags)[::-1]
-
-        flags = list(map(lambda x: bool(int(x)), flags))
-        flags = Flags(
-            allocated=flags[0],
-            long_file=flags[1],
-            modified=flags[5],
-            deleted=flags[6],
+        return Flags(
+            allocated=bool(flags & FLAG_ALLOCATED),
+            long_file=bool(flags & FLAG_LONG_FILE),
+            modified=bool(flags & FLAG_MODIFIED),
+            deleted=bool(flags & FLAG_DELETED),
         )
 
-        return flags
+    def _to_datetime(self, seconds):
+        return self.epoch + timedelta(seconds=seconds)
+
+    def _to_timestamp(self, seconds):
+        # the epoch is naive local time, so the UTC offset depends on the date
+        return self._to_datetime(seconds).timestamp()
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.fp.close()
+        try:
+            self._mm.close()
+        finally:
+            self.fp.close()
 
     def _get_file_data(self, fnode):
         return self._gather_blocks(fnode.block_pointers)
 
     def _gather_blocks(self, block_pointers):
-        content = b''
+        block_size = self.rmx_volume_information.block_size
+        if isinstance(block_pointers, FileNodePointers):
+            total = sum(block_pointers.num_blocks) * block_size
+        else:
+            total = sum(num_blocks for num_blocks, _ in block_pointers) * block_size
+
+        runs = self._coalesce_block_pointers(block_pointers)
+
+        content = bytearray(total)
+        offset = 0
+        with memoryview(content) as view, memoryview(self._mm) as mm_view:
+            for num_blocks, first_block in runs:
+                start = first_block * block_size
+                length = num_blocks * block_size
+                run = mm_view[start:start + length]
+                view[offset:offset + len(run)] = run
+                offset += len(run)
+
+        # a truncated image yields less data, like _copy_blocks
+        del content[offset:]
+        return bytes(content)
+
+    def _copy_blocks(self, block_pointers, fileobj, zero_copy=False):
+        '''
+        write the blocks to `fileobj`. With `zero_copy`, views of the mapping
+        are written directly, only use it for files that cannot keep them.
+        '''
+        block_size = self.rmx_volume_information.block_size
+        runs = self._coalesce_block_pointers(block_pointers)
+
+        if not zero_copy:
+            for num_blocks, first_block in runs:
+                start = first_block * block_size
+                fileobj.write(self._mm[start:start + num_blocks * block_size])
+            return
+
+        with memoryview(self._mm) as mm_view:
+            for num_blocks, first_block in runs:
+                start = first_block * block_size
+                fileobj.write(mm_view[start:start + num_blocks * block_size])
 
+    @staticmethod
+    def _coalesce_block_pointers(block_pointers):
+        ''' merge runs that continue directly where the previous one ended '''
+        merged = []
         for num_blocks, first_block in block_pointers:
-            content += self._read_blocks(num_blocks, first_block)
+            if merged and merged[-1][0] + merged[-1][1] == first_block:
+                merged[-1][0] += num_blocks
+            else:
+                merged.append([num_blocks, first_block])
 
-        return content
+        return [BlockPointer(*run) for run in merged]
 
-    def _read_blocks(self, num_blocks, first_block):
-        ''' read  `num_blocks` volume blocks starting from `first_block` '''
-        return self._read_without_position_change(
-            first_block * self.rmx_volume_information.block_size,
-            num_blocks * self.rmx_volume_information.block_size
-        )
-
-    @lru_cache()
     def _read_directory(self, fnode):
         ''' returns a dict mapping filenames to file nodes for the given directory '''
+        fnode_id = self._fnode_ids[id(fnode)]
+        try:
+            return self._directory_cache[fnode_id]
+        except KeyError:
+            pass
+
         assert fnode.type == 'directory'
 
-        data = self._get_file_data(fnode)
-        fmt = 'H14s'
-        size = struct.calcsize(fmt)
+        data = memoryview(self._get_file_data(fnode))
+        size = _DIRENT_STRUCT.size
         files = {}
         for first_byte in range(0, len(data), size):
+            # free slots point to fnode 0, the fnode file itself
+            if data[first_byte] == 0 and data[first_byte + 1] == 0:
+                continue
+            if (
+                data[first_byte + 2] == _DELETED_ENTRY_NAME[0]
+                and data[first_byte + 2:first_byte + size] == _DELETED_ENTRY_NAME
+            ):
+                continue
+
             try:
-                fnode, name = struct.unpack(fmt, data[first_byte:first_byte + size])
-                if name == 14 * b'@':
-                    continue
+                fnode, name = _DIRENT_STRUCT.unpack_from(data, first_byte)
                 name = name.strip(b'\x00').decode('ascii')
                 if self._fnodes[fnode].type in ('directory', 'data'):
                     files[name] = self._fnodes[fnode]
@@ -344,6 +453,7 @@ class FileSystem:
                 msg = 'Could not read file entry {} at fnode {} in directory'
                 logging.warn(msg.format(name, fnode))
 
+        self._directory_cache[fnode_id] = files
         return files
 
     def ls(self, directory=None):
@@ -360,16 +470,30 @@ class FileSystem:
             raise IOError('No such directory: {}'.format(directory))
 
     def walk(self, base=None):
+        '''
+        yields (path, dirs, files) for every directory below `base`,
+        where dirs and files are lists of (name, fnode) tuples.
+        Use `open_fnode` to get a File or Directory for an entry.
+        '''
         base = self.abspath(base) if base else self._cwd
-        basedir = self[base]
 
-        files = [basedir[f] for f in basedir.files]
-        dirs = [basedir[d] for d in basedir.directories]
+        stack = [(self._split_path(base), self._path_to_fnode(base))]
+        while stack:
+            parts, fnode = stack.pop()
+
+            files = []
+            dirs = []
+            for entry in self._read_directory(fnode).items():
+                if entry[1].type == 'data':
+                    files.append(entry)
+                elif entry[1].type == 'directory':
+                    dirs.append(entry)
 
-        yield base, dirs, files
+            yield '/' + '/'.join(parts), dirs, files
 
-        for d in dirs:
-            yield from self.walk(base=d.abspath)
+            stack.extend(
+                (parts + (name, ), child) for name, child in reversed(dirs)
+            )
 
     def abspath(self, path):
         if path.startswith('/'):
@@ -380,6 +504,16 @@ class FileSystem:
         return self._cwd
 
 
+def _extract_file(fs, fnode, outfile):
+    with open(outfile, 'wb') as of:
+        fs._copy_blocks(fnode.block_pointers, of, zero_copy=True)
+
+    os.utime(outfile, (
+        fs._to_timestamp(fnode.access_time),
+        fs._to_timestamp(fnode.modification_time),
+    ))
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Extract files from an irmx86 device or image',
@@ -390,17 +524,26 @@ def main():
     args = parser.parse_args()
 
     with FileSystem(args.device) as fs:
+        # walk first, so the directory caches are only filled from this thread
+        # keyed by output path, as replacing spaces can make names collide
+        to_extract = {}
         for root, dirs, files in fs.walk('/'):
             os.makedirs(args.output + root, exist_ok=True)
-            for f in files:
-                outfile = os.path.join(args.output + root, f.name.replace(' ', '_'))
-                with open(outfile, 'wb') as of:
-                    of.write(f.read())
-
-                os.utime(
-                    outfile,
-                    (f.access_time.timestamp(), f.modification_time.timestamp())
-                )
+            for name, fnode in files:
+                outfile = os.path.join(args.output + root, name.replace(' ', '_'))
+                if outfile in to_extract:
+                    msg = 'Multiple files are extracted to {}, keeping {}'
+                    logging.warning(msg.format(outfile, os.path.join(root, name)))
+                to_extract[outfile] = fnode
+
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # consuming map re-raises the first error and cancels pending files
+            for _ in executor.map(
+                _extract_file,
+                repeat(fs), to_extract.values(), to_extract.keys(),
+            ):
+                pass
 
 
 if __name__ == '__main__':
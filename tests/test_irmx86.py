@@ -0,0 +1,130 @@
+import os
+import struct
+import tempfile
+import unittest
+
+import irmx86
+
+BLOCK_SIZE = 512
+FNODE_SIZE = 90
+FNODE_START = 2 * BLOCK_SIZE
+NUM_FNODES = 8
+ROOT_FNODE = 6
+LONG_FILE_FNODE = 7
+ROOT_DIR_BLOCK = 10
+
+# byte offsets of the indirect block tables of the long file, listed in the
+# order of its direct pointers: out of disk order, overlapping, close
+# together and far apart
+TABLES = [
+    (1, 40 * BLOCK_SIZE),
+    (2, 20 * BLOCK_SIZE),
+    (1, 20 * BLOCK_SIZE + 300),
+    (2, 20 * BLOCK_SIZE + 4),
+]
+TABLE_ENTRIES = {
+    40 * BLOCK_SIZE: [(3, 0x010203)],
+    20 * BLOCK_SIZE: [(1, 0x000030), (2, 0x0a0b0c), (4, 0x000100)],
+    20 * BLOCK_SIZE + 300: [(5, 0x123456)],
+}
+
+
+def fnode(flags, file_type, pointers):
+    pointer_data = b''.join(
+        struct.pack('<H3s', num_blocks, first_block.to_bytes(3, 'little'))
+        for num_blocks, first_block in pointers
+    )
+    return struct.pack(
+        '<HBBHIIIII40sI4xH9sH', flags, file_type, 1, 0, 0, 0, 0, 0, 0,
+        pointer_data, 0, 0, b'', ROOT_FNODE,
+    ).ljust(FNODE_SIZE, b'\x00')
+
+
+def build_long_file_image():
+    image = bytearray(64 * BLOCK_SIZE)
+
+    struct.pack_into(
+        '<10sxBHIHIHH100x', image, 384, b'test', 4, BLOCK_SIZE, len(image),
+        NUM_FNODES, FNODE_START, FNODE_SIZE, ROOT_FNODE,
+    )
+    struct.pack_into(
+        '3sx6ss60xs4x2sxs48x', image, 768, b'VOL', b'', b'N', b'1', b'05', b'1',
+    )
+
+    allocated = irmx86.FLAG_ALLOCATED
+    fnodes = {
+        0: fnode(allocated, 0, []),
+        ROOT_FNODE: fnode(allocated, 6, [(1, ROOT_DIR_BLOCK)]),
+        LONG_FILE_FNODE: fnode(allocated | irmx86.FLAG_LONG_FILE, 8, TABLES),
+    }
+    for fnode_id, data in fnodes.items():
+        offset = FNODE_START + fnode_id * FNODE_SIZE
+        image[offset:offset + FNODE_SIZE] = data
+
+    struct.pack_into(
+        'H14s', image, ROOT_DIR_BLOCK * BLOCK_SIZE, LONG_FILE_FNODE, b'long'
+    )
+
+    for start, entries in TABLE_ENTRIES.items():
+        for i, (num_blocks, first_block) in enumerate(entries):
+            struct.pack_into(
+                '<B3s', image, start + 4 * i,
+                num_blocks, first_block.to_bytes(3, 'little'),
+            )
+
+    return bytes(image)
+
+
+def read_table(image, num_entries, start):
+    ''' decode one indirect block table on its own, like the original parser '''
+    pointers = []
+    for offset in range(start, start + 4 * num_entries, 4):
+        num_blocks, address = struct.unpack('<B3s', image[offset:offset + 4])
+        pointers.append((num_blocks, int.from_bytes(address, 'little')))
+    return pointers
+
+
+class RecordingFileSystem(irmx86.FileSystem):
+    ''' keeps track of the reads done after the volume headers '''
+
+    def _read_at(self, start, num_bytes):
+        if start != 0:
+            self.reads.append((start, num_bytes))
+        return super()._read_at(start, num_bytes)
+
+    def __init__(self, *args, **kwargs):
+        self.reads = []
+        super().__init__(*args, **kwargs)
+
+
+class TestIndirectBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.image = build_long_file_image()
+        fd, self.path = tempfile.mkstemp(suffix='.img')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.image)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_long_file_pointers(self):
+        expected = []
+        for num_entries, start in TABLES:
+            expected.extend(read_table(self.image, num_entries, start))
+
+        with RecordingFileSystem(self.path) as fs:
+            long_file = fs['/long']
+            self.assertTrue(long_file.fnode.flags.long_file)
+            pointers = [tuple(p) for p in long_file.fnode.block_pointers]
+            # the tables are parsed in place, without copying reads
+            self.assertEqual(fs.reads, [])
+
+        # one table after the other, in the order of the direct pointers
+        self.assertEqual(pointers, expected)
+        self.assertEqual(pointers[0], (3, 0x010203))
+        self.assertEqual(pointers[-2:], [(2, 0x0a0b0c), (4, 0x000100)])
+
+
+if __name__ == '__main__':
+    unittest.main()